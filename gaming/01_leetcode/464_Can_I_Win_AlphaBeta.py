@@ -1,48 +1,65 @@
+import array
+import math
+
 
 # AC
 class Solution:
-    from functools import lru_cache
-    @lru_cache(maxsize=None)
-    # currentTotal < desiredTotal
-    def alpha_beta(self, status: int, currentTotal: int, isMaxPlayer: bool, alpha: int, beta: int) -> int:
-        import math
-        if status == self.allUsed:
-            return 0  # draw: no winner
-
-        if isMaxPlayer:
-            value = -math.inf
-            for i in range(1, self.maxChoosableInteger + 1):
-                if not (status >> i & 1):
+    UNKNOWN = 2  # dp sentinel, game values are -1, 0, 1
+
+    def canIWin(self, maxChoosableInteger: int, desiredTotal: int) -> bool:
+        allUsed = 0
+        for i in range(1, maxChoosableInteger + 1):
+            allUsed = 1 << i | allUsed
+        # one int8 per status instead of an lru_cache entry per (status, currentTotal, isMaxPlayer, alpha, beta)
+        dp = array.array('b', bytes([Solution.UNKNOWN]) * (allUsed + 1))
+        UNKNOWN = Solution.UNKNOWN
+        inf = math.inf
+
+        # closure over locals: the recursion reads dp and the problem constants without attribute lookups on self
+        # currentTotal < desiredTotal
+        def alpha_beta(status: int, currentTotal: int, isMaxPlayer: bool, alpha: int, beta: int) -> int:
+            v = dp[status]
+            if v != UNKNOWN:
+                return v
+            if status == allUsed:
+                return 0  # draw: no winner
+
+            # status fixes currentTotal and the player to move, but a value cut off by (alpha, beta) is only a bound.
+            # alpha < 1 and beta > -1 always hold below the root, so only 0 can be a bound, and only when the window is narrowed.
+            isFullWindow = alpha == -1 and beta == 1
+            # bit scan over the unused numbers only, largest first: it is the most likely to reach desiredTotal at once
+            remaining = ~status & allUsed
+            if isMaxPlayer:
+                value = -inf
+                while remaining:
+                    i = remaining.bit_length() - 1
+                    remaining ^= 1 << i
                     new_status = 1 << i | status
-                    if currentTotal + i >= self.desiredTotal:
+                    if currentTotal + i >= desiredTotal:
+                        dp[status] = 1
                         return 1  # shortcut
-                    value = max(value, self.alpha_beta(new_status, currentTotal + i, not isMaxPlayer, alpha, beta))
+                    value = max(value, alpha_beta(new_status, currentTotal + i, not isMaxPlayer, alpha, beta))
                     alpha = max(alpha, value)
                     if alpha >= beta:
-                        return value
-            return value
-        else:
-            value = math.inf
-            for i in range(1, self.maxChoosableInteger + 1):
-                if not (status >> i & 1):
+                        break
+            else:
+                value = inf
+                while remaining:
+                    i = remaining.bit_length() - 1
+                    remaining ^= 1 << i
                     new_status = 1 << i | status
-                    if currentTotal + i >= self.desiredTotal:
+                    if currentTotal + i >= desiredTotal:
+                        dp[status] = -1
                         return -1  # shortcut
-                    value = min(value, self.alpha_beta(new_status, currentTotal + i, not isMaxPlayer, alpha, beta))
+                    value = min(value, alpha_beta(new_status, currentTotal + i, not isMaxPlayer, alpha, beta))
                     beta = min(beta, value)
                     if alpha >= beta:
-                        return value
+                        break
+            if value != 0 or isFullWindow:
+                dp[status] = value
             return value
 
-
-    def canIWin(self, maxChoosableInteger: int, desiredTotal: int) -> bool:
-        self.maxChoosableInteger = maxChoosableInteger
-        self.desiredTotal = desiredTotal
-        self.allUsed = 0
-        for i in range(1, maxChoosableInteger + 1):
-            self.allUsed = 1 << i | self.allUsed
-
-        return self.alpha_beta(0, 0, True, -1, 1) == 1
+        return alpha_beta(0, 0, True, -1, 1) == 1
 
 
 
@@ -1,3 +1,5 @@
+import math
+
 
 # AC
 class Solution:
@@ -5,7 +7,6 @@ class Solution:
     @lru_cache(maxsize=None)
     # currentTotal < desiredTotal
     def minimax(self, status: int, currentTotal: int, isMaxPlayer: bool) -> int:
-        import math
         if status == self.allUsed:
             return 0  # draw: no winner
 
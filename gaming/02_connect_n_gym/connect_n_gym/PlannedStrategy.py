@@ -1,29 +1,45 @@
 import copy
 import math
-from typing import Tuple
+from typing import List, Tuple
 
+import numpy as np
+
+from connect_n_gym.TranspositionTable import TranspositionTable
 from connect_n_gym.connect_n import ConnectNGame
 from connect_n_gym.strategy import Strategy
 
 
 class PlannedMinimaxStrategy(Strategy):
+    # dpMap entry flags: the stored value is exact, or only a lower / upper bound of the real value
+    EXACT = 0
+    LOWER_BOUND = 1
+    UPPER_BOUND = 2
+
     def __init__(self, game: ConnectNGame):
         super().__init__()
         self.game = copy.deepcopy(game)
-        self.dpMap = {}
-        self.result = self.minimax()
+        self.dpMap = TranspositionTable()
+        self.initSymmetries(game.board_size)
+        self.initZobrist(game.board_size)
+        self.initMoveOrder(game.board_size)
+        self.resetHashes()
+        self.result = self.search()
         print(self.result)
 
     def action(self, game) -> Tuple[int, Tuple[int, int]]:
+        self.game = copy.deepcopy(game)
+        self.resetHashes()
+        game = self.game
         bestMove = None
         assert not game.gameOver
         if game.currentPlayer == ConnectNGame.PLAYER_A:
             ret = -math.inf
             for pos in game.getAvailablePositions():
                 move = pos
-                game.move(*pos)
-                result, _ = self.dpMap[game.getStatus()]
-                game.undo()
+                result = self.makeMove(*pos)
+                if result is None:
+                    result = self.search()
+                self.undoMove()
                 ret = max(ret, result)
                 bestMove = move if ret == result else bestMove
             return ret, bestMove
@@ -31,84 +47,158 @@ class PlannedMinimaxStrategy(Strategy):
             ret = math.inf
             for pos in game.getAvailablePositions():
                 move = pos
-                game.move(*pos)
-                result, _ = self.dpMap[game.getStatus()]
-                game.undo()
+                result = self.makeMove(*pos)
+                if result is None:
+                    result = self.search()
+                self.undoMove()
                 ret = min(ret, result)
                 bestMove = move if ret == result else bestMove
             return ret, bestMove
 
-    def updateDP(self, status, result):
-        similarStates = self.similarStatus(status)
-        for s in similarStates:
-            if not s in self.dpMap:
-                self.dpMap[s] = result
-
-    def minimax(self) -> int:
-        similarStates = self.similarStatus(self.game.getStatus())
-        for s in similarStates:
-            if s in self.dpMap:
-                return self.dpMap[s]
+    def initSymmetries(self, N: int):
+        # symmetryPerms[i]: flat cell index permutation of the i-th symmetry, the 4 rotations then their mirror images
+        cells = np.arange(N * N).reshape(N, N)
+        rotations = [np.rot90(cells, k) for k in range(4)]
+        self.symmetryPerms = [perm.ravel() for perm in rotations + [np.fliplr(rotated) for rotated in rotations]]
+
+    def initZobrist(self, N: int):
+        # game.hash keys the board itself, one transformed copy of the game's Zobrist table per remaining
+        # symmetry keeps the hashes of the other 7 symmetric boards in step
+        zobrist = np.array(ConnectNGame._Z[N], dtype=np.uint64)
+        self.zobristTables = [table.tolist() for table in self.similarStatus(zobrist)[1:]]
+        # symmetricMoves[i][r * N + c]: flat index where move (r, c) lands on the board keyed by hashes[i]
+        cells = np.arange(N * N).reshape(N, N)
+        self.symmetricMoves = [table.ravel().tolist() for table in self.similarStatus(cells)[1:]]
+
+    def initMoveOrder(self, N: int):
+        # center first: central cells take part in the most lines
+        center = (N - 1) / 2
+        positions = [(r, c) for r in range(N) for c in range(N)]
+        self.orderedPositions = sorted(positions, key=lambda pos: (pos[0] - center) ** 2 + (pos[1] - center) ** 2)
+
+    def orderedMoves(self, ttMove: Tuple[int, int]) -> List[Tuple[int, int]]:
+        board = self.game.board
+        positions = [pos for pos in self.orderedPositions if board[pos[0]][pos[1]] == ConnectNGame.AVAILABLE]
+        if ttMove is not None and ttMove in positions:
+            positions.remove(ttMove)
+            positions.insert(0, ttMove)
+        return positions
+
+    def resetHashes(self):
+        game = self.game
+        self.hashes = [0] * len(self.zobristTables)
+        for r in range(game.board_size):
+            for c in range(game.board_size):
+                player = game.board[r][c]
+                if player != ConnectNGame.AVAILABLE:
+                    self.toggle(r, c, player)
+
+    def toggle(self, r: int, c: int, player: int):
+        hashes = self.hashes
+        for i, table in enumerate(self.zobristTables):
+            hashes[i] ^= table[r][c][player]
+
+    def makeMove(self, r: int, c: int):
+        self.toggle(r, c, self.game.currentPlayer)
+        return self.game.move(r, c)
+
+    def undoMove(self):
+        r, c = self.game.actionStack[-1]
+        self.toggle(r, c, self.game.board[r][c])
+        self.game.undo()
+
+    def updateDP(self, result: int, flag: int, depth: int, bestMove: Tuple[int, int]):
+        move = bestMove[0] * self.game.board_size + bestMove[1]
+        self.dpMap.put(self.game.hash, result, flag, depth, move)
+        for h, moves in zip(self.hashes, self.symmetricMoves):
+            self.dpMap.put(h, result, flag, depth, moves[move])
+
+    def search(self) -> int:
+        """
+        iterative deepening over minimax: each pass leaves best moves in dpMap that order the next, deeper pass
+        """
+        # no aspiration window: results are only -1, 0, 1 and a pass stops at 1 or -1 anyway,
+        # so a window around the previous value would be (-1, 1) and prune exactly like the full window
+        for depth in range(1, self.game.remainingPosNum + 1):
+            value = self.minimax(depth, -math.inf, math.inf)
+            if value == 1 or value == -1:
+                break  # forced result, deeper passes cannot change it
+        return value
+
+    def minimax(self, depth: int, alpha, beta) -> int:
+        game = self.game
+        # a pass reaching beyond the remaining empty cells is a full search
+        depth = min(depth, game.remainingPosNum)
+        alphaOrig, betaOrig = alpha, beta
+        ttMove = None
+        entry = self.dpMap.get(game.hash)
+        if entry is not None:
+            value, flag, entryDepth, move = entry
+            ttMove = divmod(move, game.board_size)
+            # shallower entries only help move ordering
+            if entryDepth >= depth:
+                if flag == PlannedMinimaxStrategy.EXACT:
+                    return value
+                elif flag == PlannedMinimaxStrategy.LOWER_BOUND:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+        if depth == 0:
+            return ConnectNGame.RESULT_TIE  # horizon: no forced result found, scored as a tie
         print(f'{len(self.game.actionStack)}: {len(self.dpMap)}')
 
-        game = self.game
         bestMove = None
         assert not game.gameOver
-        thisState = game.getStatus()
 
         if game.currentPlayer == ConnectNGame.PLAYER_A:
             ret = -math.inf
-            for pos in game.getAvailablePositions():
-                move = pos
-                result = game.move(*pos)
+            for pos in self.orderedMoves(ttMove):
+                result = self.makeMove(*pos)
                 if result is None:
                     assert not game.gameOver
-                    result = self.minimax()
-                game.undo()
-                ret = max(ret, result)
-                bestMove = move if ret == result else bestMove
-                if ret == 1:
-                    self.updateDP(thisState, ret)
-                    return 1
-            self.updateDP(thisState, ret)
-            return ret
+                    result = self.minimax(depth - 1, alpha, beta)
+                self.undoMove()
+                if result > ret:
+                    ret, bestMove = result, pos
+                alpha = max(alpha, ret)
+                if alpha >= beta or ret == 1:
+                    break
         else:
             ret = math.inf
-            for pos in game.getAvailablePositions():
-                move = pos
-                result = game.move(*pos)
+            for pos in self.orderedMoves(ttMove):
+                result = self.makeMove(*pos)
                 if result is None:
                     assert not game.gameOver
-                    result = self.minimax()
-                game.undo()
-                ret = min(ret, result)
-                bestMove = move if ret == result else bestMove
-                if ret == -1:
-                    self.updateDP(thisState, ret)
-                    return -1
-            self.updateDP(thisState, ret)
-            return ret
-
-
-    def similarStatus(self, status):
-        ret = []
-        rotatedS = status
-        for _ in range(4):
-            rotatedS = self.rotate(rotatedS)
-            ret.append(rotatedS)
-
+                    result = self.minimax(depth - 1, alpha, beta)
+                self.undoMove()
+                if result < ret:
+                    ret, bestMove = result, pos
+                beta = min(beta, ret)
+                if alpha >= beta or ret == -1:
+                    break
+
+        # fail-soft bounds; 1 and -1 are exact even outside the window since no result lies beyond them.
+        # the horizon only ever scores a tie, so a win or loss is forced and holds at any depth
+        if ret <= alphaOrig and ret != -1:
+            flag = PlannedMinimaxStrategy.UPPER_BOUND
+        elif ret >= betaOrig and ret != 1:
+            flag = PlannedMinimaxStrategy.LOWER_BOUND
+        else:
+            flag = PlannedMinimaxStrategy.EXACT
+        if ret == 1 or ret == -1:
+            depth = game.remainingPosNum
+        self.updateDP(ret, flag, depth, bestMove)
         return ret
 
-
-    def rotate(self, s):
-        N = len(s)
-        board = [[ConnectNGame.AVAILABLE] * N for _ in range(N)]
-
-        for r in range(N):
-            for c in range(N):
-                board[c][N-1-r] = s[r][c]
-
-        return tuple([tuple(board[i]) for i in range(N)])
+    def similarStatus(self, status) -> List[np.ndarray]:
+        """
+        the 8 symmetric images of an N x N grid (extra trailing axes are carried along), identity first
+        """
+        grid = np.asarray(status)
+        cells = grid.reshape(len(self.symmetryPerms[0]), *grid.shape[2:])
+        return [cells[perm].reshape(grid.shape) for perm in self.symmetryPerms]
 
 
 if __name__ == '__main__':
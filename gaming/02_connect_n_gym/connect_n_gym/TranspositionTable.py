@@ -0,0 +1,60 @@
+import array
+from typing import Optional, Tuple
+
+
+class TranspositionTable:
+    """
+    Open addressing table from 64-bit Zobrist keys to (value, flag, depth, move), laid out like a chess engine TT:
+    a uint64 key array and a packed uint32 entry array, 12 bytes per slot instead of a dict entry plus boxed tuple.
+
+    value is -1, 0 or 1, flag < 4, depth < 2048 and move a flat board index < 65536. Entry 0 marks an empty slot,
+    so key 0 (the empty board) is a valid key. A slot keeps its deeper entry when a shallower search rewrites it.
+    """
+
+    def __init__(self, capacity: int = 1 << 16):
+        assert capacity & (capacity - 1) == 0, 'capacity must be a power of two'
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity: int):
+        self.mask = capacity - 1
+        self.keys = array.array('Q', bytes(8 * capacity))
+        self.entries = array.array('I', bytes(4 * capacity))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def slot(self, key: int) -> int:
+        keys, entries, mask = self.keys, self.entries, self.mask
+        i = key & mask
+        while entries[i] and keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, key: int) -> Optional[Tuple[int, int, int, int]]:
+        entry = self.entries[self.slot(key)]
+        if not entry:
+            return None
+        return ((entry >> 1) & 3) - 1, (entry >> 3) & 3, (entry >> 5) & 0x7FF, entry >> 16
+
+    def put(self, key: int, value: int, flag: int, depth: int, move: int):
+        i = self.slot(key)
+        entry = self.entries[i]
+        if not entry:
+            self.size += 1
+        elif (entry >> 5) & 0x7FF > depth:
+            return
+        self.keys[i] = key
+        self.entries[i] = 1 | (value + 1) << 1 | flag << 3 | depth << 5 | move << 16
+        # linear probing degrades quickly past 2/3 load
+        if 3 * self.size > 2 * len(self.keys):
+            self.grow()
+
+    def grow(self):
+        keys, entries = self.keys, self.entries
+        self.allocate(2 * len(keys))
+        for key, entry in zip(keys, entries):
+            if entry:
+                i = self.slot(key)
+                self.keys[i] = key
+                self.entries[i] = entry
@@ -1,4 +1,5 @@
-from typing import List, Tuple
+import random
+from typing import Dict, List, Tuple
 
 class ConnectNGame:
 
@@ -9,6 +10,9 @@ class ConnectNGame:
     RESULT_A_WIN = 1
     RESULT_B_WIN = -1
 
+    # _Z[board_size][r][c][player]: Zobrist words shared by all games of a board size, PLAYER_B (-1) maps to the last slot
+    _Z: Dict[int, List[List[List[int]]]] = {}
+
     def __init__(self, N:int = 3, board_size:int = 3):
         assert N <= board_size
         self.N = N
@@ -19,6 +23,9 @@ class ConnectNGame:
         self.currentPlayer = ConnectNGame.PLAYER_A
         self.remainingPosNum = board_size * board_size
         self.actionStack = []
+        if board_size not in ConnectNGame._Z:
+            ConnectNGame._Z[board_size] = [[[0, random.getrandbits(64), random.getrandbits(64)] for _ in range(board_size)] for _ in range(board_size)]
+        self.hash = 0
 
     def move(self, r: int, c: int):
         """
@@ -29,6 +36,7 @@ class ConnectNGame:
         """
         assert self.board[r][c] == ConnectNGame.AVAILABLE
         self.board[r][c] = self.currentPlayer
+        self.hash ^= ConnectNGame._Z[self.board_size][r][c][self.currentPlayer]
         self.actionStack.append((r, c))
         self.remainingPosNum -= 1
         if self.checkWin(r, c):
@@ -45,6 +53,7 @@ class ConnectNGame:
         if len(self.actionStack) > 0:
             lastAction = self.actionStack.pop()
             r, c = lastAction
+            self.hash ^= ConnectNGame._Z[self.board_size][r][c][self.board[r][c]]
             self.board[r][c] = ConnectNGame.AVAILABLE
             self.currentPlayer = ConnectNGame.PLAYER_A if len(self.actionStack) % 2 == 0 else ConnectNGame.PLAYER_B
             self.remainingPosNum += 1
@@ -1,5 +1,5 @@
 import math
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
 
@@ -9,11 +9,9 @@ import torch.optim as optim
 from torch import Tensor
 import torch.autograd as autograd
 import torch.nn.functional as F
-from torch.autograd import Variable
-from torch.utils.data import Dataset, DataLoader
 # plt.switch_backend('agg')
 
-from rl_pytorch.TSP_dataset import TSPDataset, TSPUnlabeledDataset
+from rl_pytorch.TSP_dataset import TSPDataset
 
 USE_CUDA = False
 
@@ -29,6 +27,19 @@ def rnn_init(rnn_type: str, **kwargs) -> nn.RNNBase:
         rnn = getattr(nn, rnn_type)(**kwargs)
     return rnn
 
+def iterate_batches(data: Tensor, batch_size: int, shuffle: bool) -> Iterator[Tensor]:
+    """
+    Slices mini batches straight out of a device resident tensor, no DataLoader collate or host to device copy
+    Args:
+        data: [num_samples * 2 * seq_len]
+    Returns:
+        batches of [batch_size * 2 * seq_len]
+    """
+    num_samples = data.size(0)
+    order = torch.randperm(num_samples, device=data.device) if shuffle else torch.arange(num_samples, device=data.device)
+    for i in range(0, num_samples, batch_size):
+        yield data[order[i:i + batch_size]]
+
 class Attention(nn.Module):
     use_tanh: bool
     C: int
@@ -58,22 +69,41 @@ class Attention(nn.Module):
             ref:    [batch_size * hidden_size * seq_len]
             logits: [batch_size * seq_len]
         """
+        ref = self.precompute_ref(ref)
+        return ref, self.forward_cached(query, ref)
+
+    def precompute_ref(self, ref: Tensor) -> Tensor:
+        """
+        Projection of ref that only depends on the encoder outputs, compute once per decode and pass to forward_cached
+        Args:
+            ref: [batch_size * seq_len * hidden_size]
+        Returns:
+            ref: [batch_size * hidden_size * seq_len]
+        """
+        ref = ref.permute(0, 2, 1)
+        if self.name == 'Bahdanau':
+            ref = self.W_ref(ref)  # [batch_size x hidden_size * seq_len]
+        elif self.name != 'Dot':
+            raise NotImplementedError
+        return ref
 
-        batch_size = ref.size(0)
-        seq_len = ref.size(1)
+    def forward_cached(self, query: Tensor, ref: Tensor) -> Tensor:
+        """
+        Args:
+            query: [batch_size * hidden_size]
+            ref:   [batch_size * hidden_size * seq_len], output of precompute_ref
+        Returns:
+            logits: [batch_size * seq_len]
+        """
 
         if self.name == 'Bahdanau':
-            ref = ref.permute(0, 2, 1)
             query = self.W_query(query).unsqueeze(2)  # [batch_size * hidden_size x 1]
-            ref = self.W_ref(ref)  # [batch_size x hidden_size * seq_len]
-            expanded_query = query.repeat(1, 1, seq_len)  # [batch_size * hidden_size * seq_len]
-            V = self.V.unsqueeze(0).unsqueeze(0).repeat(batch_size, 1, 1)  # [batch_size * 1 * hidden_size]
-            logits = torch.bmm(V, torch.tanh(expanded_query + ref)).squeeze(1)
+            # query broadcasts over seq_len and V is contracted directly, neither is repeated per batch
+            logits = torch.einsum('h,bhs->bs', self.V, torch.tanh(query + ref))  # [batch_size * seq_len]
 
         elif self.name == 'Dot':
-            query = query.unsqueeze(2)
-            logits = torch.bmm(ref, query).squeeze(2)  # [batch_size * seq_len x 1]
-            ref = ref.permute(0, 2, 1)
+            query = query.unsqueeze(1)
+            logits = torch.bmm(query, ref).squeeze(1)  # [batch_size * seq_len]
 
         else:
             raise NotImplementedError
@@ -82,7 +112,7 @@ class Attention(nn.Module):
             logits = self.C * torch.tanh(logits)
         else:
             logits = logits
-        return ref, logits
+        return logits
 
 
 class GraphEmbedding(nn.Module):
@@ -99,17 +129,11 @@ class GraphEmbedding(nn.Module):
         Args:
             batch_input: [batch_size * 2 * seq_len]
         Returns:
-            embedded: [batch_size * input_size * embedding_size]
+            embedded: [batch_size * seq_len * embedding_size]
 
         """
-        batch_size = batch_input.size(0)
-        seq_len = batch_input.size(2)
-        embedding = self.embedding.repeat(batch_size, 1, 1)
-        embedded = []
-        batch_input = batch_input.unsqueeze(1)
-        for i in range(seq_len):
-            embedded.append(torch.bmm(batch_input[:, :, :, i].float(), embedding))
-        embedded = torch.cat(embedded, 1)
+        # [batch_size * seq_len * 2] @ [2 * embedding_size], one matmul for all cities
+        embedded = batch_input.transpose(1, 2).float() @ self.embedding
         return embedded
 
 
@@ -134,42 +158,48 @@ class GraphEmbedding(nn.Module):
 
 class Decoder(nn.Module):
 
-    def apply_mask_to_logits(self, logits: Tensor, mask: Tensor, idxs: Tensor) -> Tuple[Tensor, Tensor]:
+    def apply_mask_to_logits(self, logits: Tensor, mask: Tensor, idxs: Optional[Tensor], city_bits: Tensor) -> Tuple[Tensor, Tensor]:
         """
         Args:
             logits: [batch_size * seq_len]
-            mask:   [batch_size * seq_len]
+            mask:   [batch_size], int64 bitmask of visited cities, bit i set once city i is chosen
             idxs:   None or tensor [batch_size]
+            city_bits: [seq_len], 1 << i for city i, built once per decode by the caller
         Returns:
-            logits:      []
-            mask_clone:  []
+            logits:      [batch_size * seq_len]
+            mask:        [batch_size]
         """
-        batch_size = logits.size(0)
-        mask_clone = mask.clone()
-
         if idxs is not None:
-            mask_clone[[i for i in range(batch_size)], idxs.data] = 1
-            logits[mask_clone] = -np.inf
-        return logits, mask_clone
+            mask = mask | city_bits[idxs]
+            logits = logits.masked_fill((mask.unsqueeze(1) & city_bits) != 0, float('-inf'))
+        return logits, mask
 
 
 class StochasticDecoder(Decoder):
-    def __init__(self, embedding_size, hidden_size, num_glimpse, use_tanh, tanh_exploration):
+    # TorchScript keeps asserts (python -O does not strip them) and the check syncs with the host every step,
+    # so it is a compile time constant that is off unless debugging
+    check_samples: torch.jit.Final[bool]
+
+    def __init__(self, embedding_size, hidden_size, num_glimpse, use_tanh, tanh_exploration, check_samples=False):
         super(StochasticDecoder, self).__init__()
 
+        self.check_samples = check_samples
+
         self.embedding_size = embedding_size
         self.hidden_size = hidden_size
         self.num_glimpse = num_glimpse
 
-        self.rnn = rnn_init('GRU', input_size = embedding_size, hidden_size=hidden_size, batch_first=True, bidirectional=False)
+        # decodes one step at a time, GRUCell avoids the per call sequence overhead of nn.GRU
+        self.rnn_cell = nn.GRUCell(embedding_size, hidden_size)
         self.decoder_start_input = nn.Parameter(torch.FloatTensor(embedding_size))
         self.decoder_start_input.data.uniform_(-(1. / math.sqrt(embedding_size)), 1. / math.sqrt(embedding_size))
         self.glimpse = Attention(hidden_size, use_tanh=False)
         self.pointer = Attention(hidden_size, use_tanh=use_tanh, C=tanh_exploration)
 
 
-    def forward(self, decoder_input, batch_input, hidden, encoder_outputs):
+    def forward(self, decoder_input: Tensor, batch_input: Tensor, hidden: Tensor, encoder_outputs: Tensor) -> Tuple[List[Tensor], List[Tensor], List[Tensor], Tensor]:
         """
+        TorchScript compatible, PointerNet runs it scripted so the decode loop is not dispatched op by op from Python
         Args:
             decoder_input: [batch_size x embedding_size]
             batch_input: [batch_size * seq_len * embedding_dim]
@@ -178,41 +208,48 @@ class StochasticDecoder(Decoder):
         """
         batch_size = batch_input.size(0)
         seq_len = batch_input.size(1)
-        prob_list = []
-        action_idx_list = []
-        # mask = torch.zeros(batch_size, seq_len).byte()
-        mask = torch.zeros(batch_size, seq_len).bool()
-
-        idxs = None
+        prob_list: List[Tensor] = []
+        log_prob_list: List[Tensor] = []
+        action_idx_list: List[Tensor] = []
+        # visited cities as one int64 bitmask per tour instead of a [batch_size * seq_len] bool tensor cloned every step
+        assert seq_len <= 64
+        mask = torch.zeros(batch_size, dtype=torch.long, device=batch_input.device)
+        city_bits = torch.ones(seq_len, dtype=torch.long, device=batch_input.device) << torch.arange(seq_len, device=batch_input.device)
+        batch_idx = torch.arange(batch_size, device=batch_input.device)
+
+        idxs: Optional[Tensor] = None
+        # encoder_outputs is fixed for the whole decode, project it once instead of every step
+        glimpse_ref = self.glimpse.precompute_ref(encoder_outputs)
+        pointer_ref = self.pointer.precompute_ref(encoder_outputs)
 
         for i in range(seq_len):
-            _, hidden = self.rnn(decoder_input.unsqueeze(1), hidden)
-
-            if isinstance(hidden, tuple):
-                query = hidden[0].squeeze(0)
-            else:
-                query = hidden.squeeze(0)
-            for i in range(self.num_glimpse):
-                ref, logits = self.glimpse(query, encoder_outputs)
-                logits, mask = self.apply_mask_to_logits(logits, mask, idxs)
-                query = torch.bmm(ref, F.softmax(logits, dim=1).unsqueeze(2)).squeeze(2)
-
-            _, logits = self.pointer(query, encoder_outputs)
-            logits, mask = self.apply_mask_to_logits(logits, mask, idxs)
-            probs = F.softmax(logits, dim=1)
-
-            idxs = probs.multinomial(1).squeeze(1)  # [batch_size]
-            for old_idxs in action_idx_list:
-                if old_idxs.eq(idxs).data.any():
-                    print(f'{seq_len} resample')
-                    idxs = probs.multinomial(1).squeeze(1)
-                    break
-            decoder_input = batch_input[[i for i in range(batch_size)], idxs.data, :]  # [batch_size * embedded_size]
+            hidden = self.rnn_cell(decoder_input, hidden)  # [batch_size * hidden_size]
+
+            query = hidden
+            for _ in range(self.num_glimpse):
+                logits = self.glimpse.forward_cached(query, glimpse_ref)
+                logits, mask = self.apply_mask_to_logits(logits, mask, idxs, city_bits)
+                query = torch.bmm(glimpse_ref, F.softmax(logits, dim=1).unsqueeze(2)).squeeze(2)
+
+            logits = self.pointer.forward_cached(query, pointer_ref)
+            logits, mask = self.apply_mask_to_logits(logits, mask, idxs, city_bits)
+            # log_softmax is finite at every unmasked city, unlike log(softmax) which underflows.
+            # kept in float32 under autocast, multinomial needs full precision probs
+            log_probs = F.log_softmax(logits.float(), dim=1)
+            probs = log_probs.exp()
+
+            # visited cities are -inf in logits, so they have zero probability and are never drawn again
+            sampled = probs.multinomial(1).squeeze(1)  # [batch_size]
+            if self.check_samples:
+                assert not bool((mask & city_bits[sampled]).any())
+            decoder_input = batch_input[batch_idx, sampled, :]  # [batch_size * embedded_size]
 
             prob_list.append(probs)
-            action_idx_list.append(idxs)
+            log_prob_list.append(log_probs)
+            action_idx_list.append(sampled)
+            idxs = sampled
 
-        return prob_list, action_idx_list, hidden
+        return prob_list, log_prob_list, action_idx_list, hidden
 
 
 class BeamDecoder(Decoder):
@@ -241,16 +278,16 @@ class BeamDecoder(Decoder):
         batch_size = batch_input.size(0)
         seq_len = batch_input.size(1)
         prob_list = []
+        log_prob_list = []
         action_idx_list = []
-        # mask = torch.zeros(batch_size, seq_len).byte()
-        mask = torch.zeros(batch_size, seq_len).bool()
+        mask = torch.zeros(batch_size, dtype=torch.long, device=batch_input.device)
 
         idxs = None
 
         for i in range(seq_len):
             pass
 
-        return prob_list, action_idx_list, hidden
+        return prob_list, log_prob_list, action_idx_list, hidden
 
 
 class PointerNet(nn.Module):
@@ -274,17 +311,26 @@ class PointerNet(nn.Module):
 
         self.num_glimpse = num_glimpse
         self.encoder = rnn_init(rnn_type, input_size = embedding_size, hidden_size=hidden_size, batch_first=True, bidirectional=False)
-        self.decoder = StochasticDecoder(embedding_size, hidden_size, num_glimpse=num_glimpse, use_tanh=use_tanh, tanh_exploration=tanh_exploration)
+        self.decoder = torch.jit.script(StochasticDecoder(embedding_size, hidden_size, num_glimpse=num_glimpse, use_tanh=use_tanh, tanh_exploration=tanh_exploration))
         self.decoder_start_input = nn.Parameter(torch.FloatTensor(embedding_size))
         self.decoder_start_input.data.uniform_(-(1. / math.sqrt(embedding_size)), 1. / math.sqrt(embedding_size))
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the former nn.GRU decoder: decoder.rnn.<param>_l0 has the same shape as decoder.rnn_cell.<param>.
+        # translated here since the scripted decoder does not run Python overrides of its own
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            gru_key = f'{prefix}decoder.rnn.{name}_l0'
+            if gru_key in state_dict:
+                state_dict[f'{prefix}decoder.rnn_cell.{name}'] = state_dict.pop(gru_key)
+        super(PointerNet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    def forward(self, batch_input: Tensor) -> Tuple[List[Tensor], List[Tensor]]:
+    def forward(self, batch_input: Tensor) -> Tuple[List[Tensor], List[Tensor], List[Tensor]]:
         """
         Args:
             batch_input: [batch_size * 2 * seq_len]
         Returns:
             prob_list:        [batch_size * seq_len][seq_len]
+            log_prob_list:    [batch_size * seq_len][seq_len]
             action_idx_list:  [batch_size][seq_len]
         """
         batch_size = batch_input.size(0)
@@ -296,9 +342,13 @@ class PointerNet(nn.Module):
             batch_input = batch_input.permute(0, 2, 1)  # [batch_size * seq_len * embedded_size]
 
         encoder_outputs, hidden = self.encoder(batch_input)
+        # encoder final state [1 * batch_size * hidden_size], LSTM encoders give (h, c)
+        if isinstance(hidden, tuple):
+            hidden = hidden[0]
+        hidden = hidden.squeeze(0)
         decoder_input = self.decoder_start_input.unsqueeze(0).repeat(batch_size, 1)
-        pointer_probs, input_idxs, dec_hidden_t = self.decoder(decoder_input, batch_input, hidden, encoder_outputs)
-        return pointer_probs, input_idxs
+        pointer_probs, pointer_log_probs, input_idxs, dec_hidden_t = self.decoder(decoder_input, batch_input, hidden, encoder_outputs)
+        return pointer_probs, pointer_log_probs, input_idxs
 
 
 class CombinatorialRL(nn.Module):
@@ -309,7 +359,7 @@ class CombinatorialRL(nn.Module):
 
         self.actor = PointerNet(rnn_type, use_embedding, embedding_size, hidden_size, seq_len, num_glimpse, tanh_exploration, use_tanh, attention)
 
-    def forward(self, batch_input: Tensor) -> Tuple[Tensor, List[Tensor], List[Tensor], List[Tensor]]:
+    def forward(self, batch_input: Tensor) -> Tuple[Tensor, List[Tensor], List[Tensor], List[Tensor], List[Tensor]]:
         """
         Args:
             batch_input: [batch_size * 2 * seq_len]
@@ -318,41 +368,34 @@ class CombinatorialRL(nn.Module):
             action_prob_list: List of [seq_len], tensor shape [batch_size]
             action_list:      List of [seq_len], tensor shape [batch_size * 2]
             action_idx_list:  List of [seq_len], tensor shape [batch_size]
+            action_log_prob_list: List of [seq_len], tensor shape [batch_size]
         """
-        batch_size = batch_input.size(0)
-        seq_len = batch_input.size(2)
-        prob_list, action_idx_list = self.actor(batch_input)
+        prob_list, log_prob_list, action_idx_list = self.actor(batch_input)
 
-        action_list = []
-        batch_input = batch_input.transpose(1, 2)
-        for action_id in action_idx_list:
-            action_list.append(batch_input[[x for x in range(batch_size)], action_id.data, :])
-        action_prob_list = []
-        for prob, action_id in zip(prob_list, action_idx_list):
-            action_prob_list.append(prob[[x for x in range(batch_size)], action_id.data])
+        idxs = torch.stack(action_idx_list, dim=1)  # [batch_size * seq_len]
+        batch_input = batch_input.transpose(1, 2)  # [batch_size * seq_len * 2]
+        actions = batch_input.gather(1, idxs.unsqueeze(2).expand(-1, -1, 2))  # [batch_size * seq_len * 2]
+        action_probs = torch.stack(prob_list, dim=1).gather(2, idxs.unsqueeze(2)).squeeze(2)  # [batch_size * seq_len]
+        action_log_probs = torch.stack(log_prob_list, dim=1).gather(2, idxs.unsqueeze(2)).squeeze(2)  # [batch_size * seq_len]
 
-        R = self.reward(action_list)
+        R = self.reward(actions)
 
-        return R, action_prob_list, action_list, action_idx_list
+        return R, list(action_probs.unbind(1)), list(actions.unbind(1)), action_idx_list, list(action_log_probs.unbind(1))
 
 
-    def reward(self, sample_solution: List[Tensor]) -> Tensor:
+    def reward(self, sample_solution: Tensor) -> Tensor:
         """
         Computes total distance of tour
         Args:
-            sample_solution: list of size N, each tensor of shape [batch_size * 2]
+            sample_solution: [batch_size * seq_len * 2], cities in visiting order
 
         Returns:
             tour_len: [batch_size]
 
         """
-        batch_size = sample_solution[0].size(0)
-        n = len(sample_solution)
-        tour_len = Variable(torch.zeros([batch_size]))
-
-        for i in range(n - 1):
-            tour_len += torch.norm(sample_solution[i] - sample_solution[i + 1], dim=1)
-        tour_len += torch.norm(sample_solution[n - 1] - sample_solution[0], dim=1)
+        # edge i goes from city i to city i + 1, the last one closes the tour back to city 0
+        edges = sample_solution.roll(-1, dims=1) - sample_solution
+        tour_len = edges.norm(dim=2).sum(1)
         return tour_len
 
 
@@ -376,6 +419,7 @@ if __name__ == "__main__":
     parser.add_argument("--threshold", type=float, default=3.99)
     parser.add_argument("--rnn_type", type=str, default='GRU')
     parser.add_argument("--log_dir", type=str, default="./log")
+    parser.add_argument("--use_bf16", type=int, default=1)
 
     args = parser.parse_args()
 
@@ -383,36 +427,38 @@ if __name__ == "__main__":
     use_tanh = True
     beta = 0.9
 
-    RL_model = CombinatorialRL(args.rnn_type, args.use_embedding, args.embedding_size, args.hidden_size, 10, args.num_glimpse, tanh_exploration, use_tanh, attention="Dot")
+    device = torch.device(f'cuda:{args.gpu}' if USE_CUDA and torch.cuda.is_available() else 'cpu')
+    # bf16 only pays off on GPUs, CPUs without native bf16 run the autocast forward slower than float32
+    use_bf16 = bool(args.use_bf16) and device.type == 'cuda'
+    RL_model = CombinatorialRL(args.rnn_type, args.use_embedding, args.embedding_size, args.hidden_size, 10, args.num_glimpse, tanh_exploration, use_tanh, attention="Dot").to(device)
 
+    # whole data set lives on device as one [num_samples * 2 * seq_len] tensor
     use_random_ds = True
     if use_random_ds:
-        train_dataset = TSPUnlabeledDataset(10, args.random_train_size)
-        validate_dataset = TSPUnlabeledDataset(10, args.random_validate_size)
-        train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=0)
-        validate_loader = DataLoader(validate_dataset, batch_size=args.batch_size, shuffle=True, num_workers=0)
+        torch.manual_seed(9)
+        train_data = torch.rand(args.random_train_size, 2, 10, device=device)
+        validate_data = torch.rand(args.random_validate_size, 2, 10, device=device)
     else:
         train_ds = TSPDataset(args.train_filename, 10, 10)
-        test_ds = TSPDataset(args.validate_file, 10, 10)
-        train_loader = DataLoader(train_ds, num_workers=0, batch_size=args.batch_size)
-        validate_loader = DataLoader(test_ds, num_workers=0, batch_size=args.batch_size)
+        test_ds = TSPDataset(args.validate_filename, 10, 10)
+        train_data = torch.from_numpy(np.stack([item[0] for item in train_ds.data])).to(device)
+        validate_data = torch.from_numpy(np.stack([item[0] for item in test_ds.data])).to(device)
 
     actor_optim = optim.Adam(RL_model.actor.parameters(), lr=1e-4)
-    critic_exp_mvg_avg = torch.zeros(1)
+    critic_exp_mvg_avg = torch.zeros(1, device=device)
     threshold_stop = False
 
     for epoch in range(args.num_epoch):
         batch_id = 0
-        for batch_item in train_loader:
-            batch_input = batch_item[0] # [batch_size * 2 * seq_len]
+        for batch_input in iterate_batches(train_data, args.batch_size, shuffle=True):  # [batch_size * 2 * seq_len]
             batch_id += 1
             train_tour = []
             print(f'{epoch}: {batch_id}')
             RL_model.train()
 
-            batch_input = Variable(batch_input)
-
-            R, prob_list, action_list, actions_idx_list = RL_model(batch_input)
+            # bf16 autocast for the small GEMMs of the forward pass, backward runs outside of it
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                R, prob_list, action_list, actions_idx_list, log_prob_list = RL_model(batch_input)
 
             if batch_id == 0:
                 critic_exp_mvg_avg = R.mean()
@@ -421,11 +467,7 @@ if __name__ == "__main__":
 
             advantage = R - critic_exp_mvg_avg
 
-            log_probs = 0
-            for prob in prob_list:
-                log_prob = torch.log(prob)
-                log_probs += log_prob
-            log_probs[log_probs < -1000] = 0.
+            log_probs = sum(log_prob_list)  # [batch_size]
 
             reinforce = advantage * log_probs
             actor_loss = reinforce.mean()
@@ -443,9 +485,9 @@ if __name__ == "__main__":
             if batch_id % 100 == 0:
                 validate_tour = []
                 RL_model.eval()
-                for validate_batch in validate_loader:
-                    batch_input_validate = Variable(validate_batch)
-                    R, prob_list, action_list, actions_idx_list = RL_model(batch_input_validate)
+                for batch_input_validate in iterate_batches(validate_data, args.batch_size, shuffle=False):
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                        R, prob_list, action_list, actions_idx_list, log_prob_list = RL_model(batch_input_validate)
                     validate_tour.append(R.mean().item())
 
                 validate_tour_avg_r = sum(validate_tour) / len(validate_tour)